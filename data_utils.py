@@ -51,14 +51,68 @@ def generate_batch(data_batch):
     }
 
 
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler that groups samples of similar text length.
+
+    Samples are grouped into pools of `bucket_size` batches, sorted by length
+    within each pool, and cut into batches, so every batch is padded to its
+    own (near-uniform) max length instead of a much longer outlier. This cuts
+    the padded text_length the convolution and attention run over.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            random.shuffle(indices)
+
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=lambda i: self.lengths[i])
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
 def get_dataset_loader(config, dataset, shuffle=False, train=True):
+    loader_kwargs = {
+        'num_workers': config.data_workers,
+        'collate_fn': generate_batch,
+        # pinned batches are required for truly asynchronous H2D copies
+        'pin_memory': 'cuda' in config.device.type,
+    }
+    if config.data_workers > 0:
+        # keep workers alive across epochs and stage batches ahead of time
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = 4
+
+    if train and config.bucket_batching \
+            and not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        lengths = [min(len(sample['text']), dataset.max_seq_length) for sample in dataset.data]
+        batch_sampler = BucketBatchSampler(lengths, config.batch_size, shuffle=shuffle)
+        return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, **loader_kwargs)
+
+    sampler = None
+    if train and torch.distributed.is_available() and torch.distributed.is_initialized():
+        # each rank sees a distinct shard of the training set
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+        shuffle = False
     dataset_loader = torch.utils.data.DataLoader(
         dataset,
         batch_size=config.batch_size if train else config.eval_batch_size,
         shuffle=shuffle,
-        num_workers=config.data_workers,
-        collate_fn=generate_batch,
-        pin_memory='cuda' in config.device.type,
+        sampler=sampler,
+        **loader_kwargs,
     )
     return dataset_loader
 
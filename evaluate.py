@@ -2,6 +2,7 @@ import re
 
 import numpy as np
 import pandas as pd
+import torch
 from sklearn.metrics import f1_score, multilabel_confusion_matrix, ndcg_score, roc_curve, auc
 from tqdm import tqdm
 
@@ -32,7 +33,10 @@ def evaluate(config, model, dataset_loader, eval_metric, split='dev', dump=True)
     log.info(f'Time for evaluating {split} set = {timer.time():.2f} (s)')
     print(eval_metric)
     metrics = eval_metric.get_metrics()
-    if dump:
+    # under DDP every rank evaluates; only rank 0 appends to the run log
+    is_main_rank = not (torch.distributed.is_available() and torch.distributed.is_initialized()) \
+        or torch.distributed.get_rank() == 0
+    if dump and is_main_rank:
         dump_log(config, metrics, split)
 
     return metrics
@@ -71,12 +75,13 @@ class FewShotMetrics():
         self.y_pred = []
 
     def add(self, y_true, y_pred):
-        self.y_true.append(y_true)
-        self.y_pred.append(y_pred)
+        # copy so appended batches never alias a reused score buffer
+        self.y_true.append(np.array(y_true))
+        self.y_pred.append(np.array(y_pred))
 
     def add_batch(self, y_true, y_pred):
-        self.y_true.append(y_true)
-        self.y_pred.append(y_pred)
+        self.y_true.append(np.array(y_true))
+        self.y_pred.append(np.array(y_pred))
 
     def filter_instances(self, label_idxs, y_true, y_pred):
         """1. Instances that do not contains labels idxs are removed
@@ -140,6 +145,50 @@ class MetricTypes:
     NDCG = 'NDCG'
 
 
+class RunningMultiLabelMetric(object):
+    """Accumulates micro precision / recall / F1 on the compute device.
+
+    The per-class TP/FP/FN counters stay as int64 tensors on the device the
+    predictions live on, so `add_batch` does not force a GPU->CPU sync per
+    batch; the single sync happens when `get_metrics` is called.
+    """
+
+    def __init__(self, class_num, threshold=0.5):
+        self.class_num = class_num
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        # lazily allocated on the device of the first batch
+        self.tp = None
+        self.fp = None
+        self.fn = None
+
+    def add_batch(self, targets, preds):
+        pred_one_hot = preds.detach() >= self.threshold
+        target_one_hot = targets.detach() > 0
+        if self.tp is None:
+            zeros = torch.zeros(self.class_num, dtype=torch.int64, device=preds.device)
+            self.tp, self.fp, self.fn = zeros, zeros.clone(), zeros.clone()
+        self.tp += (pred_one_hot & target_one_hot).sum(dim=0)
+        self.fp += (pred_one_hot & ~target_one_hot).sum(dim=0)
+        self.fn += (~pred_one_hot & target_one_hot).sum(dim=0)
+
+    def get_metrics(self, beta=1):
+        if self.tp is None:
+            return {MetricTypes.PRECISION: 0., MetricTypes.RECALL: 0., MetricTypes.F1: 0.}
+
+        # 'micro' average: one sync for all three counters
+        tp, fp, fn = (counter.sum().item() for counter in (self.tp, self.fp, self.fn))
+        precision = tp / (tp + fp) if tp + fp > 0 else 0.
+        recall = tp / (tp + fn) if tp + fn > 0 else 0.
+        beta2 = beta ** 2
+        denom = beta2 * precision + recall
+        f_score = (1 + beta2) * precision * recall / denom if denom > 0 else 0.
+        return {MetricTypes.PRECISION: precision, MetricTypes.RECALL: recall,
+                MetricTypes.F1: f_score}
+
+
 class MultiLabelMetric(object):
     def __init__(self, class_num, thresholds=None, n_workers=1):
         if thresholds is None:
@@ -42,11 +42,15 @@ def get_config():
     parser.add_argument('--seed', type=int, help='Random seed (default: %(default)s)')
     parser.add_argument('--epochs', type=int, default=10000, help='Number of epochs to train (default: %(default)s)')
     parser.add_argument('--batch_size', type=int, default=16, help='Size of training batches (default: %(default)s)')
-    parser.add_argument('--optimizer', default='adam', choices=['adam', 'sgd'], help='Optimizer: SGD or Adam (default: %(default)s)')
+    parser.add_argument('--optimizer', default='adamw', choices=['adam', 'adamw', 'sgd'], help='Optimizer: SGD, Adam, or AdamW (default: %(default)s)')
     parser.add_argument('--learning_rate', type=float, default=0.0001, help='Learning rate for optimizer (default: %(default)s)')
     parser.add_argument('--weight_decay', type=float, default=0, help='Weight decay factor (default: %(default)s)')
     parser.add_argument('--momentum', type=float, default=0.9, help='Momentum factor for SGD only (default: %(default)s)')
     parser.add_argument('--patience', type=int, default=5, help='Number of epochs to wait for improvement before early stopping (default: %(default)s)')
+    parser.add_argument('--accumulation_steps', type=int, default=1, help='Number of batches to accumulate gradients over before an optimizer step (default: %(default)s)')
+    parser.add_argument('--bucket_batching', action='store_true', help='Group training samples of similar length into batches to reduce padding (default: %(default)s)')
+    parser.add_argument('--sparse_embedding', action='store_true', help='Use sparse embedding gradients with a dedicated SparseAdam optimizer (default: %(default)s)')
+    parser.add_argument('--fp16_embedding', action='store_true', help='Keep the embedding table in FP16 (frozen) to halve its GPU memory; CUDA only (default: %(default)s)')
 
     # model
     parser.add_argument('--model_name', default='cnn', choices=['caml', 'cnn'], help='Model to be used (default: %(default)s)')
@@ -67,9 +71,11 @@ def get_config():
 
     # others
     parser.add_argument('--cpu', action='store_true', help='Disable CUDA')
+    parser.add_argument('--compile', action='store_true', help='Optimize the network with torch.compile; requires PyTorch 2.x (default: %(default)s)')
     parser.add_argument('--display_iter', type=int, default=100, help='Log state after every n steps (default: %(default)s)')
     parser.add_argument('--data_workers', type=int, default=1, help='Use multi-cpu core for data pre-processing (default: %(default)s)')
     parser.add_argument('--eval', action='store_true', help='Only run evaluation on the test set (default: %(default)s)')
+    parser.add_argument('--quantize_inference', action='store_true', help='Quantize the linear layers to INT8 before test-set inference; CPU only (default: %(default)s)')
     parser.add_argument('--load_checkpoint', help='The checkpoint to warm-up with (default: %(default)s)')
     parser.add_argument('-h', '--help', action='help')
 
@@ -93,8 +99,16 @@ def init_env(config):
             log.warning(f'the random seed should be a non-negative integer')
 
     config.device = None
+    config.local_rank = 0
     if not config.cpu and torch.cuda.is_available():
-        config.device = torch.device('cuda')
+        if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+            # launched with torchrun: one process per GPU
+            config.local_rank = int(os.environ['LOCAL_RANK'])
+            torch.cuda.set_device(config.local_rank)
+            torch.distributed.init_process_group(backend='nccl')
+            config.device = torch.device('cuda', config.local_rank)
+        else:
+            config.device = torch.device('cuda')
     else:
         config.device = torch.device('cpu')
         # https://github.com/pytorch/pytorch/issues/11201
@@ -128,6 +142,8 @@ def main():
             model = Model(config, word_dict, classes)
         model.train(datasets['train'], datasets['dev'], eval_metric)
         model.load_best()
+    if config.quantize_inference:
+        model.quantize_for_inference()
     test_loader = data_utils.get_dataset_loader(config, datasets['test'], train=False)
     evaluate(config, model, test_loader, eval_metric, split='test', dump=not config.eval)
 
@@ -1,20 +1,66 @@
+import json
 import logging
 import os
-import pickle
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import numpy as np
 import pandas as pd
+import torch.distributed as dist
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
 import data_utils
-from evaluate import MultiLabelMetric, evaluate
+from evaluate import RunningMultiLabelMetric, evaluate
 from network import get_network
 from utils import log
-from utils.utils import (AverageMeter, Timer)
+from utils.utils import Timer
+
+
+def _ckpt_to_cpu(obj):
+    """Recursively snapshot the tensors of a checkpoint dict to CPU copies."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _ckpt_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_ckpt_to_cpu(value) for value in obj]
+    return obj
+
+
+def prefetch_to_device(data_loader, device):
+    """Yield batches moved to `device` one step ahead of consumption.
+
+    The H2D copy of the next batch is issued on a side CUDA stream while the
+    current batch is still being processed, so the transfer overlaps compute.
+    On CPU this degenerates to plain iteration.
+    """
+    if device.type != 'cuda':
+        yield from data_loader
+        return
+
+    copy_stream = torch.cuda.Stream(device)
+    prev_batch = None
+    for batch in data_loader:
+        with torch.cuda.stream(copy_stream):
+            batch = {key: value.to(device, non_blocking=True)
+                     if isinstance(value, torch.Tensor) else value
+                     for key, value in batch.items()}
+        if prev_batch is not None:
+            yield prev_batch
+        # the compute stream must wait for the staged copy and keep the
+        # copied tensors alive until it has consumed them
+        torch.cuda.current_stream().wait_stream(copy_stream)
+        for value in batch.values():
+            if isinstance(value, torch.Tensor):
+                value.record_stream(torch.cuda.current_stream())
+        prev_batch = batch
+    if prev_batch is not None:
+        yield prev_batch
 
 
 class Model(object):
@@ -33,8 +79,8 @@ class Model(object):
 
         if ckpt:
             self.config.run_name = ckpt['run_name']
-            self.word_dict = ckpt['word_dict']
-            self.classes = ckpt['classes']
+            self.word_dict = word_dict
+            self.classes = classes
             self.best_metric = ckpt['best_metric']
             self.start_epoch = ckpt['epoch']
         else:
@@ -57,11 +103,48 @@ class Model(object):
 
         embed_vecs = self.word_dict.vectors
         self.network = get_network(config, embed_vecs).to(self.device)
+        if self.config.compile:
+            if hasattr(torch, 'compile'):
+                # let TorchInductor fuse the pointwise/softmax/matmul chain.
+                # Batches are padded to their own max length, so shapes vary
+                # per batch: compile with dynamic shapes instead of
+                # mode='reduce-overhead', whose CUDA graphs would re-capture
+                # on every new text_length.
+                self.network = torch.compile(self.network, dynamic=True)
+            else:
+                log.warning('torch.compile requires PyTorch 2.x; ignoring --compile.')
+        if dist.is_available() and dist.is_initialized():
+            self.network = DistributedDataParallel(
+                self.network, device_ids=[self.device.index],
+                output_device=self.device.index, find_unused_parameters=False)
         self.init_optimizer()
 
+        # scale losses to keep FP16 gradients representable when AMP is on
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.device.type == 'cuda')
+        # reused output buffer for the per-batch sigmoid scores
+        self._score_buffer = None
+
+        # checkpoint writes run on a single background thread so the next
+        # epoch starts while the previous checkpoint is still being written
+        self._save_pool = ThreadPoolExecutor(max_workers=1)
+        self._save_futures = []
+
         if ckpt:
-            self.network.load_state_dict(ckpt['state_dict'])
+            self.network_module.load_state_dict(ckpt['state_dict'])
             self.optimizer.load_state_dict(ckpt['optimizer'])
+            if self.embed_optimizer and ckpt.get('embed_optimizer'):
+                self.embed_optimizer.load_state_dict(ckpt['embed_optimizer'])
+            if 'scaler' in ckpt:
+                self.scaler.load_state_dict(ckpt['scaler'])
+
+    @property
+    def network_module(self):
+        """The underlying network, unwrapped from DistributedDataParallel and torch.compile."""
+        network = self.network
+        if isinstance(network, DistributedDataParallel):
+            network = network.module
+        # torch.compile wraps the module and keeps the original in _orig_mod
+        return getattr(network, '_orig_mod', network)
 
     def init_optimizer(self, optimizer=None):
         """Initialize an optimizer for the free parameters of the network.
@@ -69,6 +152,16 @@ class Model(object):
             state_dict: network parameters
         """
         parameters = [p for p in self.network.parameters() if p.requires_grad]
+        self.embed_optimizer = None
+        if self.config.sparse_embedding:
+            # the sparse embedding gradients need their own SparseAdam; the
+            # dense optimizers below cannot consume them
+            embed_parameters = [p for p in self.network_module.embedding.parameters()
+                                if p.requires_grad]
+            if embed_parameters:  # the embedding may be frozen (fp16_embedding)
+                embed_ids = set(id(p) for p in embed_parameters)
+                parameters = [p for p in parameters if id(p) not in embed_ids]
+                self.embed_optimizer = optim.SparseAdam(embed_parameters, lr=self.config.learning_rate)
         optimizer_name = optimizer or self.config.optimizer
         if optimizer_name == 'sgd':
             self.optimizer = optim.SGD(parameters, self.config.learning_rate,
@@ -76,12 +169,19 @@ class Model(object):
                                        weight_decay=self.config.weight_decay)
         elif optimizer_name == 'adam':
             self.optimizer = optim.Adam(parameters, weight_decay=self.config.weight_decay, lr=self.config.learning_rate)
-
+        elif optimizer_name == 'adamw':
+            try:
+                # fused: one multi-tensor CUDA kernel for the whole update
+                self.optimizer = optim.AdamW(parameters, weight_decay=self.config.weight_decay,
+                                             lr=self.config.learning_rate,
+                                             fused=self.device.type == 'cuda')
+            except (TypeError, RuntimeError):
+                # fused is unavailable on CPU and on older PyTorch
+                self.optimizer = optim.AdamW(parameters, weight_decay=self.config.weight_decay,
+                                             lr=self.config.learning_rate)
         else:
             raise RuntimeError('Unsupported optimizer: %s' % self.config.optimizer)
 
-        torch.nn.utils.clip_grad_value_(parameters, 0.5)
-
     # --------------------------------------------------------------------------
     # Learning
     # --------------------------------------------------------------------------
@@ -102,6 +202,8 @@ class Model(object):
 
                 log.info(f'============= Starting epoch {epoch} =============')
 
+                if isinstance(train_loader.sampler, DistributedSampler):
+                    train_loader.sampler.set_epoch(epoch)
                 self.train_epoch(train_loader)
 
                 log.info('Start validate Dev Dataset')
@@ -119,30 +221,48 @@ class Model(object):
                 epoch += 1
         except KeyboardInterrupt:
             log.info('training terminated')
+        finally:
+            self.wait_for_save()
+            if dist.is_available() and dist.is_initialized():
+                # rank 0 writes checkpoints in the background; the other ranks
+                # must not reach load_best before the write has finished
+                dist.barrier()
 
     def train_epoch(self, data_loader):
         """Run through one epoch of model training with the provided data loader."""
 
-        train_loss = AverageMeter()
-        metrics = MultiLabelMetric(self.config.num_class)
+        # the running loss stays a device tensor; syncing it every batch
+        # through .item() would stall the training loop
+        loss_sum = torch.zeros((), device=self.device)
+        loss_count = 0
+        metrics = RunningMultiLabelMetric(self.config.num_class)
         epoch_time = Timer()
-        progress_bar = tqdm(data_loader)
+        progress_bar = tqdm(prefetch_to_device(data_loader, self.device), total=len(data_loader))
+        accumulation_steps = self.config.accumulation_steps
 
+        self.optimizer.zero_grad(set_to_none=True)
         for idx, batch in enumerate(progress_bar):
             loss, batch_label_scores = self.train_step(batch)
-            train_loss.update(loss)
-
-            # training metrics
-            batch_labels = batch['label'].cpu().detach().numpy()
-            batch_label_scores = batch_label_scores.cpu().detach().numpy()
-            metrics.add_batch(batch_labels, batch_label_scores)
-            progress_bar.set_postfix(loss=train_loss.avg)
+            # step only every accumulation_steps batches (and on the last one)
+            if (idx + 1) % accumulation_steps == 0 or (idx + 1) == len(data_loader):
+                self.optimizer_step()
+            loss_sum += loss
+            loss_count += 1
+
+            # training metrics accumulate on-device; no per-batch GPU sync
+            metrics.add_batch(batch['label'], batch_label_scores)
+            if (idx + 1) % 50 == 0:
+                progress_bar.set_postfix(loss=(loss_sum / loss_count).item())
+        epoch_loss = (loss_sum / loss_count).item() if loss_count else 0.
         log.info(metrics.get_metrics())
         log.info(f'Epoch done. Time for epoch = {epoch_time.time():.2f} (s)')
-        log.info(f'Epoch loss: {train_loss.avg}')
+        log.info(f'Epoch loss: {epoch_loss}')
 
     def train_step(self, inputs):
-        """Forward a batch of examples; stop the optimizer to update weights.
+        """Forward a batch of examples and accumulate their gradients.
+
+        The optimizer step is issued by `train_epoch` via `optimizer_step` so
+        gradients can be accumulated over `config.accumulation_steps` batches.
         """
         # Train mode
         self.network.train()
@@ -151,19 +271,54 @@ class Model(object):
             if isinstance(inputs[key], torch.Tensor):
                 inputs[key] = inputs[key].to(self.device, non_blocking=True)
 
-        # Run forward
+        # Run forward under autocast so conv / linear matmuls use FP16 on GPU
         target_labels = inputs['label']
-        outputs = self.network(inputs['text'])
-        pred_logits = outputs['logits'] if isinstance(outputs, dict) else outputs
-        loss = F.binary_cross_entropy_with_logits(pred_logits, target_labels)
-        batch_label_scores = torch.sigmoid(pred_logits)
+        with torch.cuda.amp.autocast(enabled=self.scaler.is_enabled()):
+            outputs = self.network(inputs['text'])
+            pred_logits = outputs['logits'] if isinstance(outputs, dict) else outputs
+            loss = F.binary_cross_entropy_with_logits(pred_logits, target_labels)
+            loss = loss / self.config.accumulation_steps
+        batch_label_scores = self.sigmoid_scores(pred_logits)
+
+        self.scaler.scale(loss).backward()
+
+        # report the un-scaled loss as a device tensor; no sync here
+        return loss.detach() * self.config.accumulation_steps, batch_label_scores
 
-        # Update parameters
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+    def sigmoid_scores(self, logits):
+        """Compute sigmoid scores into a reused buffer instead of allocating.
 
-        return loss.item(), batch_label_scores
+        The buffer is lazily (re)allocated when the batch grows or the logits
+        dtype/device changes (e.g. FP16 under autocast) and sliced for smaller
+        final batches. Callers must consume or copy the scores before the
+        next step overwrites the buffer.
+        """
+        logits = logits.detach()
+        if (self._score_buffer is None
+                or self._score_buffer.shape[0] < logits.shape[0]
+                or self._score_buffer.shape[1:] != logits.shape[1:]
+                or self._score_buffer.dtype != logits.dtype
+                or self._score_buffer.device != logits.device):
+            self._score_buffer = torch.empty_like(logits)
+        scores = self._score_buffer[:logits.shape[0]]
+        torch.sigmoid(logits, out=scores)
+        return scores
+
+    def optimizer_step(self):
+        """Update the parameters with the accumulated gradients."""
+        # clip on the unscaled gradients before the optimizer step; only the
+        # dense parameters are clipped since clipping does not support the
+        # sparse embedding gradients
+        self.scaler.unscale_(self.optimizer)
+        parameters = [p for group in self.optimizer.param_groups for p in group['params']]
+        torch.nn.utils.clip_grad_value_(parameters, 0.5)
+        self.scaler.step(self.optimizer)
+        if self.embed_optimizer:
+            self.scaler.step(self.embed_optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad(set_to_none=True)
+        if self.embed_optimizer:
+            self.embed_optimizer.zero_grad(set_to_none=True)
 
     def predict(self, inputs):
         """Forward a batch of examples only to get predictions.
@@ -188,10 +343,10 @@ class Model(object):
                 inputs[key] = inputs[key].to(self.device, non_blocking=True)
 
         # Run forward
-        with torch.no_grad():
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=self.scaler.is_enabled()):
             outputs = self.network(inputs['text'])
-            logits = outputs['logits']
-            batch_label_scores = torch.sigmoid(logits)
+            logits = outputs['logits'].float()
+            batch_label_scores = self.sigmoid_scores(logits)
 
         return {
             'scores': batch_label_scores,
@@ -199,38 +354,116 @@ class Model(object):
             'outputs': outputs,
         }
 
+    def quantize_for_inference(self):
+        """Dynamically quantize the linear layers to INT8 for inference.
+
+        Dynamic quantization is CPU-only in PyTorch, so this is skipped with
+        a warning when the model runs on GPU. It also only converts nn.Linear
+        modules: CamlConvAttnPool computes its projections from the raw UF
+        parameter via einsum, which quantize_dynamic cannot touch, so a
+        warning is raised instead of silently keeping the network in FP32.
+        Checkpoints on disk stay in full precision; quantization is applied
+        on the live network only.
+        """
+        if self.device.type != 'cpu':
+            log.warning('INT8 dynamic quantization only supports CPU inference; skipping.')
+            return
+        quantized = torch.quantization.quantize_dynamic(
+            self.network_module, {torch.nn.Linear}, dtype=torch.qint8)
+        converted = sum(1 for module in quantized.modules()
+                        if 'quantized' in type(module).__module__)
+        if converted == 0:
+            log.warning('The network has no nn.Linear modules to quantize; '
+                        'ignoring --quantize_inference.')
+            return
+        self.network = quantized
+        log.info(f'Quantized {converted} linear layers to INT8.')
+
     # --------------------------------------------------------------------------
     # Saving and loading
     # --------------------------------------------------------------------------
 
+    def save_vocab(self, run_dir):
+        """Save the vocabulary and classes once per run.
+
+        The torchtext Vocab carries the full embedding vectors and can be
+        hundreds of MB, so it is written a single time instead of being
+        pickled into every per-epoch checkpoint.
+        """
+        vocab_dir = os.path.join(run_dir, 'vocab')
+        if os.path.exists(os.path.join(vocab_dir, 'word_dict.pt')):
+            return
+        os.makedirs(vocab_dir, exist_ok=True)
+        torch.save(self.word_dict, os.path.join(vocab_dir, 'word_dict.pt'))
+        with open(os.path.join(vocab_dir, 'classes.json'), 'w') as fp:
+            json.dump(self.classes, fp)
+        log.info(f'Save vocabulary and classes: {vocab_dir}')
+
     def save(self, epoch, is_best=False):
+        # only rank 0 writes checkpoints when training with DDP
+        if dist.is_available() and dist.is_initialized() and dist.get_rank() != 0:
+            return
         self.network.eval()
-        ckpt = {
+        run_dir = os.path.join(self.config.result_dir, self.config.run_name)
+        os.makedirs(run_dir, exist_ok=True)
+        self.save_vocab(run_dir)
+        # snapshot all tensors to CPU so the background write is isolated
+        # from the parameter updates of the next epoch
+        ckpt = _ckpt_to_cpu({
             'epoch': epoch,
             'run_name': self.config.run_name,
-            'state_dict': self.network.state_dict(),
-            'word_dict': self.word_dict,
-            'classes': self.classes,
+            'state_dict': self.network_module.state_dict(),
             'optimizer': self.optimizer.state_dict(),
+            'embed_optimizer': self.embed_optimizer.state_dict() if self.embed_optimizer else None,
+            'scaler': self.scaler.state_dict(),
             'best_metric': self.best_metric,
-        }
-        ckpt_path = os.path.join(self.config.result_dir,
-                                 self.config.run_name, 'model_last.pt')
-        os.makedirs(os.path.dirname(ckpt_path), exist_ok=True)
+        })
+        ckpt_path = os.path.join(run_dir, 'model_last.pt')
         log.info(f"Save current  model: {ckpt_path}")
-        torch.save(ckpt, ckpt_path)
         if is_best:
-            best_ckpt_path = ckpt_path.replace('last', 'best')
-            log.info(f"Save best model ({self.config.val_metric}: {self.best_metric}): {best_ckpt_path}")
-            shutil.copyfile(ckpt_path, best_ckpt_path)
+            log.info(f"Save best model ({self.config.val_metric}: {self.best_metric}): "
+                     f"{ckpt_path.replace('last', 'best')}")
+        # surface failures (e.g. disk full) from writes that already finished
+        for future in [f for f in self._save_futures if f.done()]:
+            self._save_futures.remove(future)
+            future.result()
+        self._save_futures.append(self._save_pool.submit(self._write_ckpt, ckpt, ckpt_path, is_best))
         self.network.train()
 
+    @staticmethod
+    def _write_ckpt(ckpt, ckpt_path, is_best):
+        # the legacy serialization format writes faster than the zipfile one
+        # write-then-rename so a later save never truncates the inode that
+        # model_best.pt is hardlinked to
+        torch.save(ckpt, ckpt_path + '.tmp', _use_new_zipfile_serialization=False)
+        os.replace(ckpt_path + '.tmp', ckpt_path)
+        if is_best:
+            best_ckpt_path = ckpt_path.replace('last', 'best')
+            if os.path.exists(best_ckpt_path):
+                os.remove(best_ckpt_path)
+            try:
+                # O(1) and atomic, instead of a byte copy
+                os.link(ckpt_path, best_ckpt_path)
+            except OSError:
+                shutil.copyfile(ckpt_path, best_ckpt_path)
+
+    def wait_for_save(self):
+        """Block until pending checkpoint writes finish, surfacing failures."""
+        futures, self._save_futures = self._save_futures, []
+        for future in futures:
+            future.result()
+
     @staticmethod
     def load(config, ckpt_path):
         ckpt = torch.load(ckpt_path)
-        return Model(config, ckpt=ckpt)
+        vocab_dir = os.path.join(os.path.dirname(ckpt_path), 'vocab')
+        word_dict = torch.load(os.path.join(vocab_dir, 'word_dict.pt'))
+        with open(os.path.join(vocab_dir, 'classes.json')) as fp:
+            classes = json.load(fp)
+        return Model(config, word_dict, classes, ckpt=ckpt)
 
     def load_best(self):
+        self.wait_for_save()
         best_ckpt_path = os.path.join(self.config.result_dir,
                                       self.config.run_name, 'model_best.pt')
         best_model = self.load(self.config, best_ckpt_path)
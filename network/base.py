@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 
 
@@ -12,6 +13,17 @@ class BaseModel(nn.Module):
     def __init__(self, config, embed_vecs):
         super().__init__()
         self.config = config
-        self.embedding = nn.Embedding(len(embed_vecs), embed_vecs.shape[1], padding_idx=0)
-        self.embedding.weight.data = embed_vecs.clone()
+        # sparse gradients keep the embedding backward proportional to the
+        # tokens in the batch instead of the whole vocabulary
+        self.embedding = nn.Embedding(len(embed_vecs), embed_vecs.shape[1], padding_idx=0,
+                                      sparse=config.sparse_embedding)
+        weight = embed_vecs.clone()
+        if config.fp16_embedding and config.device.type == 'cuda':
+            # halve the table's memory and per-step gather bandwidth; the
+            # rows are frozen because FP16 updates without an FP32 master
+            # copy drift, and autocast handles the mixed-precision forward
+            weight = weight.half()
+        self.embedding.weight.data = weight
+        if weight.dtype == torch.float16:
+            self.embedding.weight.requires_grad_(False)
         self.embed_drop = nn.Dropout(p=config.dropout)
@@ -8,6 +8,37 @@ from torch.nn.init import xavier_uniform_
 from network.base import BaseModel
 
 
+def attn_pool_streaming(x, UF, num_class, chunk_size=64):
+    """Attention pooling with an online softmax over text_length.
+
+    Walks the text in chunks, keeping the running max, normalizer, and
+    weighted sum per (batch, class), so neither the attention matrix nor the
+    full (batch, 2 * num_class, text_length) projection is ever materialized.
+    Numerically identical to softmax followed by the weighted sum: the GEMM
+    may run in FP16 under autocast, but the softmax statistics and the
+    accumulations are kept in FP32 for stability, as torch.softmax would be.
+    """
+    batch_size = x.shape[0]
+    running_max = x.new_full((batch_size, num_class), float('-inf'), dtype=torch.float32)
+    normalizer = x.new_zeros((batch_size, num_class), dtype=torch.float32)
+    weighted_sum = x.new_zeros((batch_size, num_class), dtype=torch.float32)
+
+    for start in range(0, x.shape[1], chunk_size):
+        proj = torch.einsum('kf,blf->bkl', UF, x[:, start:start + chunk_size]).float()
+        scores = proj[:, :num_class]
+        values = proj[:, num_class:]
+
+        new_max = torch.maximum(running_max, scores.max(dim=2).values)
+        # rescale the accumulators to the new max before adding this chunk
+        scale = torch.exp(running_max - new_max)
+        weights = torch.exp(scores - new_max.unsqueeze(2))
+        normalizer = normalizer * scale + weights.sum(dim=2)
+        weighted_sum = weighted_sum * scale + torch.einsum('bcl,bcl->bc', weights, values)
+        running_max = new_max
+
+    return weighted_sum / normalizer
+
+
 class CamlConvAttnPool(BaseModel):
     def __init__(self, config, embed_vecs):
         super(CamlConvAttnPool, self).__init__(config, embed_vecs)
@@ -19,15 +50,19 @@ class CamlConvAttnPool(BaseModel):
         self.conv = nn.Conv1d(embed_vecs.shape[1], num_filter_maps, kernel_size=filter_size, padding=int(floor(filter_size/2)))
         xavier_uniform_(self.conv.weight)
 
-        # Context vectors for computing attention as in 2.2
-        self.U = nn.Linear(num_filter_maps, config.num_class)
-        xavier_uniform_(self.U.weight)
-
-        # Final layer: create a matrix to use for the L binary classifiers as in 2.3
-        self.final = nn.Linear(num_filter_maps, config.num_class)
-        xavier_uniform_(self.final.weight)
+        # Context vectors for computing attention as in 2.2 (first num_class
+        # rows) and the matrix for the L binary classifiers as in 2.3 (last
+        # num_class rows), concatenated so both projections of the conv
+        # output run as one GEMM in forward.
+        self.num_class = config.num_class
+        weight = torch.empty(2 * config.num_class, num_filter_maps)
+        xavier_uniform_(weight[:config.num_class])
+        xavier_uniform_(weight[config.num_class:])
+        self.UF = nn.Parameter(weight)
+        bound = 1 / num_filter_maps ** 0.5
+        self.final_bias = nn.Parameter(torch.empty(config.num_class).uniform_(-bound, bound))
 
-    def forward(self, text):
+    def forward(self, text, return_attention=False):
         # Get embeddings and apply dropout
         x = self.embedding(text)
         x = self.embed_drop(x)
@@ -36,16 +71,22 @@ class CamlConvAttnPool(BaseModel):
         # Apply convolution and nonlinearity (tanh / prelu)
         x = torch.tanh(self.conv(x).transpose(1,2))
 
-        # Apply attention
-        #    batch * text_length * 1200
-        # -> batch * text_length * num_class (matmul)
-        # -> batch * num_class (softmax)
-        alpha = torch.softmax(self.U.weight.matmul(x.transpose(1,2)), dim=2)
+        if return_attention:
+            # Project onto the attention context vectors and the per-label
+            # output weights at once: one (2 * num_class) x num_filter_maps
+            # GEMM against the (batch, length, features) layout.
+            proj = torch.einsum('kf,blf->bkl', self.UF, x)
 
-        # Document representations are weighted sums using the attention. Can compute all at once as a matmul
-        m = alpha.matmul(x)
+            # Apply attention: softmax over text_length as in 2.2
+            alpha = torch.softmax(proj[:, :self.num_class], dim=2)
 
-        # similarity
-        x = self.final.weight.mul(m).sum(dim=2).add(self.final.bias)
+            # The per-label similarity is the attention-weighted sum of the
+            # already-projected outputs, fused into one kernel.
+            x = torch.einsum('bcl,bcl->bc', alpha, proj[:, self.num_class:]) + self.final_bias
+            return {'logits': x, 'attention': alpha}
 
-        return {'logits': x, 'attention': alpha}
+        # Default path: stream text_length in chunks with an online softmax,
+        # so the (batch, num_class, text_length) attention matrix never
+        # round-trips through memory.
+        x = attn_pool_streaming(x, self.UF, self.num_class) + self.final_bias
+        return {'logits': x}
@@ -9,27 +9,12 @@ class ArgDict(dict):
         self.__dict__ = self
 
 
-class AverageMeter(object):
-    """Computes and stores the average and current value."""
-
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
-
 class Timer(object):
-    """Computes elasped time."""
+    """Computes elasped time.
+
+    Counters are kept as integer nanoseconds from the monotonic
+    `time.perf_counter_ns` and only converted to float seconds on read.
+    """
 
     def __init__(self):
         self.reset()
@@ -37,37 +22,41 @@ class Timer(object):
     def reset(self):
         self.running = True
         self.total = 0
-        self.start = time.time()
+        self.start = time.perf_counter_ns()
         return self
 
     def resume(self):
         if not self.running:
             self.running = True
-            self.start = time.time()
+            self.start = time.perf_counter_ns()
         return self
 
     def stop(self):
         if self.running:
             self.running = False
-            self.total += time.time() - self.start
+            self.total += time.perf_counter_ns() - self.start
         return self
 
     def time(self):
+        """Elapsed time in seconds."""
         if self.running:
-            return self.total + time.time() - self.start
-        return self.total
+            return (self.total + time.perf_counter_ns() - self.start) * 1e-9
+        return self.total * 1e-9
 
 
 def dump_log(config, metrics, split):
-    log_path = os.path.join(config.result_dir, config.run_name, 'logs.json')
+    """Append one metrics record to the run's newline-delimited JSON log."""
+    log_path = os.path.join(config.result_dir, config.run_name, 'logs.ndjson')
     os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, 'a') as fp:
+        fp.write(json.dumps({'split': split, 'metrics': metrics}) + '\n')
+
+
+def load_log(log_path):
+    """Load a logs.ndjson file back into a dict of split -> list of metrics."""
     result = {}
-    if os.path.isfile(log_path):
-        with open(log_path) as fp:
-            result = json.load(fp)
-    if split in result:
-        result[split].append(metrics)
-    else:
-        result[split] = [metrics]
-    with open(log_path, 'w') as fp:
-        json.dump(result, fp)
+    with open(log_path) as fp:
+        for line in fp:
+            record = json.loads(line)
+            result.setdefault(record['split'], []).append(record['metrics'])
+    return result